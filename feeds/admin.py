@@ -1,12 +1,32 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 from django.urls import reverse
 from django.utils.safestring import mark_safe
 
 # Register your models here.
 from feeds import models
 
+class ListChangeList(ChangeList):
+    # lets the admin slim down the changelist's queryset without
+    # affecting the edit pages, which share get_queryset()
+
+    def get_queryset(self, request, *args, **kwargs):
+        return self.model_admin.get_list_queryset(super().get_queryset(request, *args, **kwargs))
+
+class CategoryAdmin(admin.ModelAdmin):
+
+    list_display = ('name', 'unread_posts_count')
+
+    def get_changelist(self, request, **kwargs):
+        return ListChangeList
+
+    def get_list_queryset(self, queryset):
+        return queryset.with_unread_counts()
+
 class SourceAdmin(admin.ModelAdmin):
 
+    list_display = ('__str__', 'unread_posts_count')
+
     readonly_fields = (
         'posts_link',
     )
@@ -22,12 +42,20 @@ class SourceAdmin(admin.ModelAdmin):
         )
     posts_link.short_description = 'posts'
 
+    def get_changelist(self, request, **kwargs):
+        return ListChangeList
+
+    def get_list_queryset(self, queryset):
+        return queryset.with_unread_counts().for_list()
+
 class PostAdmin(admin.ModelAdmin):
 
     raw_id_fields = ('source',)
 
     list_display = ('title', 'source', 'created', 'guid', 'author')
 
+    list_select_related = ('source',)
+
     search_fields = ('title',)
 
     readonly_fields = (
@@ -45,6 +73,12 @@ class PostAdmin(admin.ModelAdmin):
         )
     enclosures_link.short_description = 'enclosures'
 
+    def get_changelist(self, request, **kwargs):
+        return ListChangeList
+
+    def get_list_queryset(self, queryset):
+        return queryset.for_list()
+
 class EnclosureAdmin(admin.ModelAdmin):
 
     raw_id_fields = ('post',)
@@ -52,7 +86,7 @@ class EnclosureAdmin(admin.ModelAdmin):
     list_display = ('href', 'type')
 
 admin.site.register(models.Tag)
-admin.site.register(models.Category)
+admin.site.register(models.Category, CategoryAdmin)
 admin.site.register(models.Source, SourceAdmin)
 admin.site.register(models.Post, PostAdmin)
 admin.site.register(models.Enclosure, EnclosureAdmin)
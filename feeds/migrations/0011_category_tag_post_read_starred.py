@@ -0,0 +1,62 @@
+# Generated by Django 4.2.30 on 2026-10-15 22:12
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0010_enclosure_description_enclosure_medium'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+            ],
+            options={
+                'verbose_name_plural': 'Categories',
+            },
+        ),
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='read',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='starred',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='source',
+            name='due_poll',
+            field=models.DateTimeField(default=datetime.datetime(1900, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='tags',
+            field=models.ManyToManyField(blank=True, related_name='post_tags', to='feeds.tag'),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='sources', to='feeds.category'),
+        ),
+        migrations.AddField(
+            model_name='source',
+            name='tags',
+            field=models.ManyToManyField(blank=True, related_name='source_tags', to='feeds.tag'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-15 22:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0011_category_tag_post_read_starred'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['source', 'read'], name='post_src_read_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['source', '-created'], name='post_src_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['source', '-index'], name='post_src_index_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-15 22:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0012_post_source_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(condition=models.Q(('read', False)), fields=['source'], name='post_unread_partial'),
+        ),
+    ]
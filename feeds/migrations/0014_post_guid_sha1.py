@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-15 22:13
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_guids(apps, schema_editor):
+    Post = apps.get_model('feeds', 'Post')
+    batch = []
+    for post in Post.objects.exclude(guid__isnull=True).exclude(guid='').only('id', 'guid').iterator(chunk_size=2000):
+        post.guid_sha1 = hashlib.sha1(post.guid.encode("utf-8")).hexdigest()
+        batch.append(post)
+        if len(batch) >= 2000:
+            Post.objects.bulk_update(batch, ['guid_sha1'])
+            batch = []
+    if batch:
+        Post.objects.bulk_update(batch, ['guid_sha1'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0013_post_unread_partial_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='guid_sha1',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=40, null=True),
+        ),
+        migrations.RunPython(hash_guids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='post',
+            name='guid',
+            field=models.CharField(blank=True, max_length=512, null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 4.2.30 on 2026-10-15 22:15
+
+from django.db import migrations, models
+
+
+def remove_duplicate_posts(apps, schema_editor):
+    # keep the oldest copy of any post that was stored twice for the same source,
+    # carrying over the user's starred / read state and tags from the others
+    Post = apps.get_model('feeds', 'Post')
+    dupes = (
+        Post.objects.exclude(guid_sha1__isnull=True)
+        .order_by()
+        .values('source_id', 'guid_sha1')
+        .annotate(copies=models.Count('id'))
+        .filter(copies__gt=1)
+    )
+    for dupe in list(dupes):
+        keep, *others = Post.objects.filter(source_id=dupe['source_id'], guid_sha1=dupe['guid_sha1']).order_by('id')
+        keep.starred = keep.starred or any(p.starred for p in others)
+        keep.read = keep.read and all(p.read for p in others)
+        keep.save(update_fields=['starred', 'read'])
+        for p in others:
+            keep.tags.add(*p.tags.all())
+        Post.objects.filter(id__in=[p.id for p in others]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0014_post_guid_sha1'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_posts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='post',
+            constraint=models.UniqueConstraint(fields=('source', 'guid_sha1'), name='uniq_source_guid'),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='guid_sha1',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-15 22:19
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('feeds', '0015_post_unique_source_guid'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='source',
+            name='interval',
+            field=models.PositiveSmallIntegerField(default=400),
+        ),
+        migrations.AlterField(
+            model_name='source',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(default=0, validators=[django.core.validators.MaxValueValidator(599)]),
+        ),
+    ]
@@ -1,15 +1,36 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.validators import MaxValueValidator
 from django.db import models
+from django.db.models.functions import Now
 
-import time
 import datetime
-from urllib.parse import urlencode
+import hashlib
+from urllib.parse import quote_plus
 import logging
-import sys
-import email
 
 
 import django.utils as django_utils
 from django.utils.deconstruct import deconstructible
+from django.utils.functional import cached_property
+
+
+_ONE_DAY = datetime.timedelta(days=1)
+
+# default for due_poll, puts new sources to the front of the queue
+_DISTANT_PAST = datetime.datetime(1900, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+_PROXY_CACHE_KEY = "feeds:webproxy:proxies"
+_PROXY_CACHE_SECONDS = 300
+
+# recast_link paths, these are served by the project not this app
+_POST_PATH = "/post/%d/"
+_ENCLOSURE_PATH = "/enclosure/%d/"
+
+
+def _utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
 
 
 @deconstructible
@@ -18,7 +39,7 @@ class ExpiresGenerator(object):
     """
 
     def __call__(self):
-        return django_utils.timezone.now() - datetime.timedelta(days=1)
+        return django_utils.timezone.now() - _ONE_DAY
 
 
 class Tag(models.Model):
@@ -28,9 +49,35 @@ class Tag(models.Model):
         return self.name
 
 
+class TaggedQuerySetMixin:
+    # for the models with a tags ManyToManyField
+
+    def with_tags(self):
+        """
+        Prefetch the tag names into prefetched_tags, use that rather than
+        tags.all() when listing.
+        """
+        return self.prefetch_related(
+            models.Prefetch('tags', queryset=Tag.objects.only('name'), to_attr='prefetched_tags')
+        )
+
+
+class CategoryQuerySet(models.QuerySet):
+
+    def with_unread_counts(self):
+        """
+        Annotate each category with its unread post count in a single query.
+        """
+        return self.annotate(
+            unread_count=models.Count('sources__posts', filter=models.Q(sources__posts__read=False))
+        )
+
+
 class Category(models.Model):
     name = models.CharField(max_length=255)
 
+    objects = CategoryQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -40,13 +87,74 @@ class Category(models.Model):
     @property
     def unread_posts_count(self):
         """
-        Dynamically calculate the count of unread posts for the category.
+        Count of unread posts for the category.
+
+        Needs the annotation from Category.objects.with_unread_counts(),
+        without it this would be a query per category.  That's an error when
+        DEBUG is on, otherwise it logs a warning and falls back to the query.
         """
+        if 'unread_count' in self.__dict__:
+            return self.unread_count
+        if settings.DEBUG:
+            raise RuntimeError("call Category.objects.with_unread_counts() first")
+        logging.warning("N+1: Category.unread_posts_count not annotated")
         return Source.objects.filter(category=self).aggregate(
             unread_count=models.Count('posts', filter=models.Q(posts__read=False))
         )['unread_count']
 
 
+class SourceQuerySet(TaggedQuerySetMixin, models.QuerySet):
+
+    def with_unread_counts(self):
+        """
+        Annotate each source with its unread post count in a single query.
+        """
+        return self.annotate(
+            unread_count=models.Count('posts', filter=models.Q(posts__read=False))
+        )
+
+    def with_style(self, now=None):
+        """
+        Fetch the sources, sharing a single timestamp (now, or the current
+        time if not given) between the garden_style and health_box of all
+        of them.  This evaluates the queryset and returns a list, so it has
+        to come last.
+        """
+        now = now or _utcnow()
+        sources = list(self)
+        for source in sources:
+            source._shared_now = now
+        return sources
+
+    def with_staleness(self):
+        """
+        Annotate how long it is since each source last changed, worked out
+        by the database.  garden_style and health_box use it when present,
+        and it can be ordered by.
+        """
+        return self.annotate(
+            stale_for=models.ExpressionWrapper(Now() - models.F('last_change'), output_field=models.DurationField())
+        )
+
+    def for_list(self):
+        """
+        Leave out the description, which lists of sources don't show.
+        """
+        return self.defer('description')
+
+
+class PollingManager(models.Manager):
+    # just the fields the poller reads, it works through a lot of sources
+    # and doesn't need their descriptions
+
+    def get_queryset(self):
+        return super().get_queryset().only(
+            'id', 'feed_url', 'etag', 'last_modified', 'last_302_url', 'last_302_start',
+            'is_cloudflare', 'interval', 'due_poll', 'num_subs', 'site_url', 'max_index', 'live',
+            'last_success', 'last_change',
+        )
+
+
 class Source(models.Model):
     # This is an actual feed that we poll
     name          = models.CharField(max_length=255, blank=True, null=True)
@@ -57,16 +165,16 @@ class Source(models.Model):
     description   = models.TextField(null=True, blank=True)
 
     last_polled   = models.DateTimeField(blank=True, null=True)
-    due_poll      = models.DateTimeField(default=django_utils.timezone.datetime(1900, 1, 1, tzinfo=datetime.timezone.utc))  # default to distant past to put new sources to front of queue
+    due_poll      = models.DateTimeField(default=_DISTANT_PAST)
     etag          = models.CharField(max_length=255, blank=True, null=True)
     last_modified = models.CharField(max_length=255, blank=True, null=True) # just pass this back and forward between server and me , no need to parse
     
     last_result    = models.CharField(max_length=255,blank=True,null=True)
-    interval       = models.PositiveIntegerField(default=400)
+    interval       = models.PositiveSmallIntegerField(default=400)  # minutes
     last_success   = models.DateTimeField(blank=True, null=True)
     last_change    = models.DateTimeField(blank=True, null=True)
     live           = models.BooleanField(default=True)
-    status_code    = models.PositiveIntegerField(default=0)
+    status_code    = models.PositiveSmallIntegerField(default=0, validators=[MaxValueValidator(599)])
     last_302_url   = models.CharField(max_length=512, null=True, blank=True)
     last_302_start = models.DateTimeField(null=True, blank=True)
     
@@ -79,6 +187,8 @@ class Source(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='sources', null=True, blank=True)
     tags = models.ManyToManyField(Tag, related_name='source_tags', blank=True)
 
+    objects = SourceQuerySet.as_manager()
+    polling = PollingManager()
 
     def __str__(self):
         return self.display_name
@@ -86,11 +196,16 @@ class Source(models.Model):
     @property
     def unread_posts_count(self):
         """
-        Dynamically calculate the count of unread posts for the source.
+        Count of unread posts for the source.
+
+        Uses the annotation from Source.objects.with_unread_counts() when
+        present, otherwise falls back to a count query.
         """
+        if 'unread_count' in self.__dict__:
+            return self.unread_count
         return self.posts.filter(read=False).count()
 
-    @property
+    @cached_property
     def best_link(self):
         #the html link else hte feed link
         if self.site_url is None or self.site_url == '':
@@ -98,59 +213,78 @@ class Source(models.Model):
         else:
             return self.site_url
 
-    @property
+    @cached_property
     def display_name(self):
         if self.name is None or self.name == "":
             return self.best_link
         else:
             return self.name
     
-    @property
-    def garden_style(self):
-        
+    def _style_days(self, now=None):
+        # with no explicit time, prefer the sums the database did for
+        # with_staleness(), then the timestamp shared by with_style()
+        if now is None:
+            stale_for = self.__dict__.get('stale_for')
+            if stale_for is not None:
+                return stale_for.days // 2
+            now = self.__dict__.get('_shared_now') or _utcnow()
+        return (now - self.last_change).days // 2
+
+    def _garden_style(self, now=None):
+
         if not self.live:
-            css = "background-color:#ccc;"
-        elif self.last_change is None or self.last_success is None:
-            css = "background-color:#D00;color:white"
-        else:
-            dd = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc) - self.last_change
-            
-            days = int (dd.days / 2)
-            
-            col = 255 - days
-            if col < 0: col = 0
-            
-            css = "background-color:#ff%02x%02x" % (col,col)
-
-            if col < 128:
-                css += ";color:white"
-            
+            return "background-color:#ccc;"
+        if self.last_change is None or self.last_success is None:
+            return "background-color:#D00;color:white"
+
+        col = max(0, min(255, 255 - self._style_days(now)))
+        css = f"background-color:#ff{col:02x}{col:02x}"
+        if col < 128:
+            css += ";color:white"
         return css
-        
-    @property
-    def health_box(self):
-        
+
+    def _health_box(self, now=None):
+
         if not self.live:
-            css="#ccc;"
-        elif self.last_change == None or self.last_success == None:
-            css="#F00;"
-        else:
-            dd = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc) - self.last_change
-
-            days = int (dd.days/2)
-            
-            red = days
-            if red > 255:
-                red = 255
-            
-            green = 255-days;
-            if green < 0:
-                green = 0
-            
-            css = "#%02x%02x00" % (red,green)
-            
-        return css
-        
+            return "#ccc;"
+        if self.last_change is None or self.last_success is None:
+            return "#F00;"
+
+        days = self._style_days(now)
+        red = max(0, min(255, days))
+        green = max(0, min(255, 255 - days))
+        return f"#{red:02x}{green:02x}00"
+
+    def garden_style_at(self, now):
+        return self._garden_style(now)
+
+    def health_box_at(self, now):
+        return self._health_box(now)
+
+    @cached_property
+    def garden_style(self):
+        return self._garden_style()
+
+    @cached_property
+    def health_box(self):
+        return self._health_box()
+
+
+class PostQuerySet(TaggedQuerySetMixin, models.QuerySet):
+
+    def with_source(self):
+        """
+        Fetch the source alongside each post, use this when listing posts
+        as __str__ needs the source's display name.
+        """
+        return self.select_related('source')
+
+    def for_list(self):
+        """
+        Leave out the body, which can be large and lists of posts don't show.
+        """
+        return self.defer('body')
+
 
 class Post(models.Model):
 
@@ -162,7 +296,8 @@ class Post(models.Model):
     link          = models.CharField(max_length=512, blank=True, null=True)
     found         = models.DateTimeField(auto_now_add=True)
     created       = models.DateTimeField(db_index=True)
-    guid          = models.CharField(max_length=512, blank=True, null=True, db_index=True)
+    guid          = models.CharField(max_length=512, blank=True, null=True)
+    guid_sha1     = models.CharField(max_length=40, blank=True, null=True, editable=False)  # guids are only ever matched exactly, index the hash not the guid
     author        = models.CharField(max_length=255, blank=True, null=True)
     index         = models.IntegerField(db_index=True)
     image_url     = models.CharField(max_length=512, blank=True,null=True)
@@ -170,40 +305,65 @@ class Post(models.Model):
     starred       = models.BooleanField(default=False)
     tags          = models.ManyToManyField(Tag, related_name='post_tags', blank=True)
 
+    objects = PostQuerySet.as_manager()
+
+    @staticmethod
+    def hash_guid(guid):
+        """
+        The value stored in guid_sha1 for a guid, for use in lookups.
+        """
+        if not guid:
+            return None
+        return hashlib.sha1(guid.encode("utf-8")).hexdigest()
+
+    def save(self, *args, **kwargs):
+        self.guid_sha1 = Post.hash_guid(self.guid)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'guid' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'guid_sha1'}
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def bulk_mark_read(cls, posts):
+        """
+        Marks every post in a queryset as read in a single query.
+        """
+        return posts.update(read=True)
+
     def mark_read(self):
         """
         Marks the post as read.
         """
+        Post.objects.filter(pk=self.pk).update(read=True)
         self.read = True
-        self.save(update_fields=['read'])
 
     def unmark_read(self):
         """
         Marks the post as unread.
         """
+        Post.objects.filter(pk=self.pk).update(read=False)
         self.read = False
-        self.save(update_fields=['read'])
 
     def toggle_starred(self):
         """
         Toggles the starred status of the post.
+
+        The flip happens in the database so two toggles at once can't
+        overwrite each other, the instance is then refreshed with the result.
         """
-        self.starred = not self.starred
-        self.save(update_fields=['starred'])
+        Post.objects.filter(pk=self.pk).update(
+            starred=models.Case(models.When(starred=True, then=models.Value(False)), default=models.Value(True))
+        )
+        self.refresh_from_db(fields=['starred'])
 
-    @property
+    @cached_property
     def title_url_encoded(self):
-        try:
-            ret = urlencode({"X":self.title})
-            if len(ret) > 2: ret = ret[2:]
-        except:
-            logging.info("Failed to url encode title of post {}".format(self.id))
-            ret = ""        
+        return quote_plus(self.title or "")
 
     def __str__(self):
         return "%s: post %d, %s" % (self.source.display_name, self.index, self.title)
         
-    @property
+    @cached_property
     def recast_link(self):
     
         # TODO: This needs to come out, it's just for recast
@@ -213,10 +373,22 @@ class Post(models.Model):
         #else:
         #    return self.link + ("?recast_id=%d" % self.id)current_subscription
         
-        return "/post/%d/" % self.id
+        return _POST_PATH % self.id
 
     class Meta:
         ordering = ["index"]
+        indexes = [
+            # unread posts for a source, and posts for a source by date / index
+            models.Index(fields=['source', 'read'], name='post_src_read_idx'),
+            models.Index(fields=['source', '-created'], name='post_src_created_idx'),
+            models.Index(fields=['source', '-index'], name='post_src_index_idx'),
+            # only the unread rows, for unread counts on large installs
+            models.Index(fields=['source'], name='post_unread_partial', condition=models.Q(read=False)),
+        ]
+        constraints = [
+            # lets the poller bulk insert posts and skip guids it already has
+            models.UniqueConstraint(fields=['source', 'guid_sha1'], name='uniq_source_guid'),
+        ]
 
 
 class Enclosure(models.Model):
@@ -228,7 +400,7 @@ class Enclosure(models.Model):
     medium = models.CharField(max_length=25, null=True, blank=True)
     description = models.CharField(max_length=512, null= True, blank=True)
     
-    @property
+    @cached_property
     def recast_link(self):
     
         # TODO: This needs to come out, it's just for recast
@@ -238,7 +410,7 @@ class Enclosure(models.Model):
         #else:
         #    return self.href + ("?recast_id=%d" % self.id)
 
-        return "/enclosure/%d/" % self.id
+        return _ENCLOSURE_PATH % self.id
         
         
 class WebProxy(models.Model):
@@ -249,4 +421,29 @@ class WebProxy(models.Model):
     def __str__(self):
         return "Proxy:{}".format(self.address)
 
+    @classmethod
+    def cached_proxies(cls):
+        """
+        All the proxies, oldest first.  Cached for a few minutes as they are
+        asked for on every Cloudflare retry and hardly ever change.
+        """
+        proxies = cache.get(_PROXY_CACHE_KEY)
+        if proxies is None:
+            proxies = list(cls.objects.order_by('id'))
+            cache.set(_PROXY_CACHE_KEY, proxies, _PROXY_CACHE_SECONDS)
+        return proxies
+
+    @classmethod
+    def clear_cache(cls):
+        cache.delete(_PROXY_CACHE_KEY)
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        WebProxy.clear_cache()
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        WebProxy.clear_cache()
+        return ret
+
         
@@ -2,15 +2,19 @@ from django.test import TestCase, Client
 from django.conf import settings
 
 # Create your tests here.
-from feeds.models import Source, Post, Enclosure, WebProxy
-from feeds.utils import read_feed, find_proxies, get_proxy, fix_relative
+from feeds.models import Category, Tag, Source, Post, Enclosure, WebProxy
+from feeds import utils
+from feeds.utils import update_feeds, read_feed, find_proxies, get_proxy, fix_relative
 
+from django.core.cache import cache
+from django.db.models import F
 from django.utils import timezone
 from django.urls import reverse
 
 from datetime import timedelta
 
 import mock
+from mock import patch
 
 import os
 
@@ -30,12 +34,29 @@ class UtilsTest(TestCase):
         html = fix_relative(html, url)
         
         self.assertEqual(html, "<a href='https://example.com/'><img src='https://example.com/image.jpg'></a>")
+
+    def test_existing_posts_in_batches(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL)
+        guids = ["http://feed.com/%d" % i for i in range(1200)]
+        Post.objects.bulk_create([
+            Post(source=src, index=i, body=" ", created=timezone.now(), guid=g, guid_sha1=Post.hash_guid(g))
+            for i, g in enumerate(guids)
+        ])
+
+        # three batches of guids, each with its enclosure prefetch
+        with self.assertNumQueries(6):
+            posts = utils._existing_posts(src, guids)
+        self.assertEqual(len(posts), 1200)
         
 
 
 class BaseTest(TestCase):
 
 
+    def setUp(self):
+        cache.clear()  # cached proxies would outlive the test's database rows
+
     def _populate_mock(self, mock, test_file, status, content_type, etag=None, headers=None, url=BASE_URL, is_cloudflare=False):
     
         content = open(os.path.join(TEST_FILES_FOLDER, test_file), "rb").read()
@@ -117,10 +138,56 @@ class XMLFeedsTest(BaseTest):
         
         self.assertEqual(src.description, 'Public posts from @xurble@toot.community') 
 
-
         self.assertEqual(src.posts.all()[0].enclosures.count(), 1)
-        
-        
+
+    def test_interval_halved(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=301)
+        src.save()
+
+        # a changed feed gets polled twice as often, in whole minutes
+        read_feed(src)
+        self.assertEqual(src.interval, 150)
+        self.assertIsInstance(src.interval, int)
+        src.refresh_from_db()
+
+        self.assertEqual(src.interval, 150)
+
+    def test_update_feeds(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/rss+xml")
+
+        src = Source(name="test1", feed_url=BASE_URL, description="A long description")
+        src.save()
+        self.assertIn("description", Source.polling.get(pk=src.pk).get_deferred_fields())
+
+        update_feeds(30)
+        src.refresh_from_db()
+
+        self.assertEqual(src.status_code, 200)
+        self.assertEqual(src.posts.count(), 1)
+        self.assertEqual(src.last_result, " OK (updated)")
+
+    def test_reread_podcast(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.xml", content_type="application/rss+xml")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src)
+        src.refresh_from_db()
+        posts = src.posts.count()
+
+        # reading it again updates the posts we have rather than adding more
+        read_feed(src)
+        src.refresh_from_db()
+
+        self.assertEqual(src.posts.count(), posts)
+        self.assertEqual(Enclosure.objects.filter(post__source=src).count(), posts)
+        self.assertTrue(all(p.guid_sha1 == Post.hash_guid(p.guid) for p in src.posts.all()))
 
 
 
@@ -263,6 +330,46 @@ class JSONFeedTest(BaseTest):
         
         self.assertEqual(post.enclosures.count(), 1)
 
+    def test_reread_podcast(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.json", content_type="application/json")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src)
+        read_feed(src)
+        src.refresh_from_db()
+
+        self.assertEqual(src.posts.count(), 1)
+        self.assertEqual(src.posts.all()[0].enclosures.count(), 1)
+
+    def test_post_inserted_by_someone_else(self, mock):
+
+        self._populate_mock(mock, status=200, test_file="podcast.json", content_type="application/json")
+
+        src = Source(name="test1", feed_url=BASE_URL, interval=0)
+        src.save()
+
+        read_feed(src)
+        src.posts.all()[0].toggle_starred()
+
+        # another poller stores the post between us looking for it and inserting it
+        lookups = []
+        def racing_lookup(source_feed, guids):
+            lookups.append(guids)
+            return {} if len(lookups) == 1 else existing_posts(source_feed, guids)
+
+        existing_posts = utils._existing_posts
+        with patch("feeds.utils._existing_posts", side_effect=racing_lookup):
+            read_feed(src)
+        src.refresh_from_db()
+
+        self.assertEqual(src.posts.count(), 1)
+        self.assertEqual(src.posts.all()[0].enclosures.count(), 1)
+        self.assertTrue(src.posts.all()[0].starred)
+        self.assertEqual(src.last_result, " OK")
+
 
 @requests_mock.Mocker()
 class HTTPStuffTest(BaseTest):
@@ -306,6 +413,12 @@ class HTTPStuffTest(BaseTest):
         
         self.assertIsNotNone(p)
 
+        # burning a proxy takes it out of the cached list
+        burned_id = p.id
+        p.delete()
+        self.assertEqual(len(WebProxy.cached_proxies()), WebProxy.objects.count())
+        self.assertNotEqual(get_proxy().id, burned_id)
+
     def test_etags(self, mock):
 
         self._populate_mock(mock, status=200, test_file="rss_xhtml_body.xml", content_type="application/xml+rss")
@@ -503,5 +616,199 @@ class HTTPStuffTest(BaseTest):
         self.assertEqual(src.posts.count(), 0) # can't have got any
         self.assertTrue(src.live)       
         self.assertEqual(src.interval, 120)
- 
-        
+
+
+
+class ModelsTest(TestCase):
+
+
+    def _make_post(self, src, index, read=False):
+        return Post.objects.create(source=src, index=index, body=" ", title="post %d" % index, created=timezone.now(), read=read)
+
+    def test_category_unread_counts(self):
+
+        cat = Category.objects.create(name="cat")
+        src = Source.objects.create(name="test1", feed_url=BASE_URL, category=cat)
+        self._make_post(src, 1)
+        self._make_post(src, 2)
+        self._make_post(src, 3, read=True)
+
+        with self.assertNumQueries(1):
+            cats = list(Category.objects.with_unread_counts())
+            self.assertEqual(cats[0].unread_posts_count, 2)
+
+        # without the annotation it still works, but complains
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(cat.unread_posts_count, 2)
+
+        with self.settings(DEBUG=True):
+            with self.assertRaises(RuntimeError):
+                cat.unread_posts_count
+
+    def test_source_unread_counts(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL)
+        Source.objects.create(name="test2", feed_url=BASE_URL)
+        self._make_post(src, 1)
+        self._make_post(src, 2, read=True)
+
+        with self.assertNumQueries(1):
+            counts = {s.name: s.unread_posts_count for s in Source.objects.with_unread_counts()}
+        self.assertEqual(counts, {"test1": 1, "test2": 0})
+
+        self.assertEqual(src.unread_posts_count, 1)
+
+    def test_post_with_source(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL)
+        self._make_post(src, 1)
+        self._make_post(src, 2)
+
+        with self.assertNumQueries(1):
+            names = [str(p) for p in Post.objects.with_source()]
+        self.assertEqual(names, ["test1: post 1, post 1", "test1: post 2, post 2"])
+
+    def test_source_display_name(self):
+
+        src = Source(feed_url=BASE_URL)
+        self.assertEqual(src.best_link, BASE_URL)
+        self.assertEqual(src.display_name, BASE_URL)
+
+        src = Source(name="test1", feed_url=BASE_URL, site_url="http://site.com/")
+        self.assertEqual(src.best_link, "http://site.com/")
+        self.assertEqual(src.display_name, "test1")
+
+    def test_source_styles(self):
+
+        now = timezone.now()
+        src = Source(name="test1", feed_url=BASE_URL, last_success=now, last_change=now - timedelta(days=20))
+        self.assertEqual(src.garden_style_at(now), "background-color:#fff5f5")
+        self.assertEqual(src.health_box_at(now), "#0af500")
+
+        src.last_change = now - timedelta(days=600)
+        self.assertEqual(src.garden_style_at(now), "background-color:#ff0000;color:white")
+        self.assertEqual(src.health_box_at(now), "#ff0000")
+
+        src.live = False
+        self.assertEqual(src.garden_style_at(now), "background-color:#ccc;")
+        self.assertEqual(src.health_box_at(now), "#ccc;")
+
+    def test_source_with_style(self):
+
+        now = timezone.now()
+        Source.objects.create(name="test1", feed_url=BASE_URL, last_success=now, last_change=now)
+        Source.objects.create(name="test2", feed_url=BASE_URL, last_success=now, last_change=now)
+
+        sources = Source.objects.order_by("name").with_style()
+        self.assertEqual(sources[0].garden_style, "background-color:#ffffff")
+        self.assertEqual(sources[0].health_box, "#00ff00")
+
+        # every source is styled as of the time given
+        sources = Source.objects.order_by("name").with_style(now + timedelta(days=20))
+        self.assertEqual([s.garden_style for s in sources], ["background-color:#fff5f5"] * 2)
+        self.assertEqual([s.health_box for s in sources], ["#0af500"] * 2)
+
+    def test_source_with_staleness(self):
+
+        now = timezone.now()
+        Source.objects.create(name="test1", feed_url=BASE_URL, last_success=now, last_change=now - timedelta(days=20))
+        Source.objects.create(name="test2", feed_url=BASE_URL, last_success=now, last_change=now - timedelta(days=600))
+        Source.objects.create(name="test3", feed_url=BASE_URL)
+
+        sources = list(Source.objects.with_staleness().order_by(F("stale_for").desc(nulls_last=True)))
+        self.assertEqual([s.name for s in sources[:2]], ["test2", "test1"])
+        self.assertEqual(sources[1].stale_for.days, 20)
+        self.assertEqual(sources[1].garden_style, "background-color:#fff5f5")
+        self.assertEqual(sources[0].health_box, "#ff0000")
+        self.assertEqual(sources[2].health_box, "#F00;")
+
+        # an explicit time wins over the annotation
+        self.assertEqual(sources[1].garden_style_at(now + timedelta(days=200)), "background-color:#ff9191")
+
+    def test_post_title_url_encoded(self):
+
+        self.assertEqual(Post(title="Hello & goodbye?").title_url_encoded, "Hello+%26+goodbye%3F")
+        self.assertEqual(Post(title=None).title_url_encoded, "")
+
+    def test_post_guid_sha1(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL)
+        p = self._make_post(src, 1)
+        self.assertIsNone(p.guid_sha1)
+
+        p.guid = "http://feed.com/1"
+        p.save(update_fields=["guid"])
+        p.refresh_from_db()
+        self.assertEqual(p.guid_sha1, Post.hash_guid("http://feed.com/1"))
+        self.assertEqual(Post.objects.get(guid_sha1=Post.hash_guid("http://feed.com/1")), p)
+
+    def test_post_read_and_starred(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL)
+        p = self._make_post(src, 1)
+        self._make_post(src, 2)
+
+        p.mark_read()
+        self.assertTrue(Post.objects.get(pk=p.pk).read)
+        p.unmark_read()
+        self.assertFalse(Post.objects.get(pk=p.pk).read)
+
+        p.toggle_starred()
+        self.assertTrue(p.starred)
+        self.assertTrue(Post.objects.get(pk=p.pk).starred)
+        p.toggle_starred()
+        self.assertFalse(Post.objects.get(pk=p.pk).starred)
+
+        # a stale copy toggling doesn't undo someone else's toggle
+        stale = Post.objects.get(pk=p.pk)
+        p.toggle_starred()
+        stale.toggle_starred()
+        self.assertFalse(stale.starred)
+        self.assertFalse(Post.objects.get(pk=p.pk).starred)
+
+        with self.assertNumQueries(1):
+            Post.bulk_mark_read(src.posts.all())
+        self.assertEqual(src.unread_posts_count, 0)
+
+    def test_for_list(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL, description="A long description")
+        self._make_post(src, 1)
+
+        self.assertEqual(Source.objects.for_list()[0].get_deferred_fields(), {"description"})
+        self.assertEqual(Post.objects.for_list()[0].get_deferred_fields(), {"body"})
+
+    def test_with_tags(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL)
+        news, tech = Tag.objects.create(name="news"), Tag.objects.create(name="tech")
+        src.tags.add(news)
+        for i in range(3):
+            self._make_post(src, i).tags.add(news, tech)
+
+        with self.assertNumQueries(2):
+            names = [sorted(t.name for t in p.prefetched_tags) for p in Post.objects.with_tags()]
+        self.assertEqual(names, [["news", "tech"]] * 3)
+
+        with self.assertNumQueries(2):
+            self.assertEqual([t.name for t in Source.objects.with_tags()[0].prefetched_tags], ["news"])
+
+    def test_recast_link(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL)
+        p = self._make_post(src, 1)
+        e = Enclosure.objects.create(post=p, href="http://feed.com/1.mp3", type="audio/mpeg")
+
+        self.assertEqual(p.recast_link, "/post/%d/" % p.id)
+        self.assertEqual(e.recast_link, "/enclosure/%d/" % e.id)
+
+    def test_recast_link_unsaved(self):
+
+        src = Source.objects.create(name="test1", feed_url=BASE_URL)
+        p = Post(source=src, index=1, body=" ", created=timezone.now(), guid="http://feed.com/1")
+
+        # no id yet, so there is no link to hand out (or to cache)
+        with self.assertRaises(TypeError):
+            p.recast_link
+        p.save()
+        self.assertEqual(p.recast_link, "/post/%d/" % p.id)
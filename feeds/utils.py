@@ -1,4 +1,4 @@
-from django.db.models import Q
+from django.db.models import Max, Q
 from django.utils import timezone
 from django.conf import settings
 
@@ -110,7 +110,7 @@ def fix_relative(html, url):
 def update_feeds(max_feeds=3, output=NullOutput()):
 
 
-    todo = Source.objects.filter(Q(due_poll__lt = timezone.now()) & Q(live = True))
+    todo = Source.polling.filter(Q(due_poll__lt = timezone.now()) & Q(live = True))
 
     
     output.write("Queue size is {}".format(todo.count()))
@@ -126,6 +126,7 @@ def update_feeds(max_feeds=3, output=NullOutput()):
     # kill shit proxies
     
     WebProxy.objects.filter(address='X').delete()
+    WebProxy.clear_cache()
     
     
 def read_feed(source_feed, output=NullOutput()):
@@ -194,7 +195,7 @@ def read_feed(source_feed, output=NullOutput()):
 
             output.write("\nBurning the proxy.")
             proxy.delete()
-            source_feed.interval /= 2
+            source_feed.interval //= 2
 
 
         
@@ -220,7 +221,7 @@ def read_feed(source_feed, output=NullOutput()):
                 # we are already proxied - this proxy on cloudflare's shit list too?
                 proxy.delete()
                 output.write("\nProxy seemed to also be blocked, burning")
-                source_feed.interval /= 2
+                source_feed.interval //= 2
                 source_feed.last_result = "Proxy kind of worked but still got cloudflared."
             else:            
                 source_feed.is_cloudflare = True
@@ -350,7 +351,7 @@ def read_feed(source_feed, output=NullOutput()):
         (ok,changed) = import_feed(source_feed=source_feed, feed_body=ret.content, content_type=content_type, output=output)
         
         if ok and changed:
-            source_feed.interval /= 2
+            source_feed.interval //= 2
             source_feed.last_result = " OK (updated)" #and temporary redirects
             source_feed.last_change = timezone.now()
             
@@ -409,6 +410,65 @@ def import_feed(source_feed, feed_body, content_type, output=NullOutput()):
     
 
     
+_BATCH_SIZE = 500
+
+
+def _guid_lookups(guids):
+
+    # one lookup per batch of guids, big feeds would otherwise go over the
+    # database's limit on query parameters
+    hashes = [Post.hash_guid(g) for g in guids if g]
+    lookups = [Q(guid_sha1__in=hashes[i:i + _BATCH_SIZE]) for i in range(0, len(hashes), _BATCH_SIZE)]
+    if not all(guids):
+        lookups.append(Q(guid=""))  # empty guids aren't hashed
+    return lookups
+
+
+def _existing_posts(source_feed, guids):
+
+    # a query per batch for the posts we already have from this feed, rather than one per entry
+    guids = set(guids)
+    posts = {}
+    for lookup in _guid_lookups(guids):
+        for p in Post.objects.filter(Q(source=source_feed) & lookup).prefetch_related("enclosures"):
+            if p.guid in guids: # guard against hash collisions
+                posts.setdefault(p.guid, p)
+    return posts
+
+
+def _save_posts(source_feed, new_posts, existing, fields):
+
+    # existing is guid -> post, any new post that turns out to be there
+    # already gets swapped for the stored one and is updated along with the rest
+
+    if new_posts:
+        for p in new_posts:
+            p.guid_sha1 = Post.hash_guid(p.guid)  # bulk_create doesn't call save()
+
+        # ignore_conflicts means we don't get the ids back, so note where they are up to
+        last_id = Post.objects.filter(source=source_feed).aggregate(last_id=Max("id"))["last_id"] or 0
+
+        # anything that snuck in since we looked is skipped by the (source, guid_sha1) constraint
+        Post.objects.bulk_create(new_posts, ignore_conflicts=True, batch_size=_BATCH_SIZE)
+
+        ids = dict(Post.objects.filter(source=source_feed, id__gt=last_id).values_list("guid", "id"))
+        for p in new_posts:
+            p.id = ids.get(p.guid)
+
+        skipped = [p for p in new_posts if p.id is None]
+        if skipped:
+            stored = _existing_posts(source_feed, [p.guid for p in skipped])
+            for p in skipped:
+                if p.guid in stored:
+                    q = stored[p.guid]
+                    for field in fields:
+                        setattr(q, field, getattr(p, field))
+                    existing[p.guid] = q
+
+    if existing:
+        Post.objects.bulk_update(list(existing.values()), fields, batch_size=_BATCH_SIZE)
+
+
 def parse_feed_xml(source_feed, feed_content, output):
 
     ok = True
@@ -480,6 +540,8 @@ def parse_feed_xml(source_feed, feed_content, output):
 
         #output.write(entries)
         entries.reverse() # Entries are typically in reverse chronological order - put them in right order
+
+        items = {}  # guid -> (entry, body), a guid repeated in the feed takes the last entry
         for e in entries:
         
 
@@ -510,16 +572,23 @@ def parse_feed_xml(source_feed, feed_content, output):
                     m = hashlib.md5()
                     m.update(body.encode("utf-8"))
                     guid = m.hexdigest()
-                    
-            try:
-                p  = Post.objects.filter(source=source_feed).filter(guid=guid)[0]
+
+            items[guid] = (e, body)
+
+        existing = _existing_posts(source_feed, items.keys())
+        posts = {}
+        new_posts = []
+
+        for guid, (e, body) in items.items():
+
+            if guid in existing:
+                p = existing[guid]
                 output.write("EXISTING " + guid + "\n")
 
-            except Exception as ex:
+            else:
                 output.write("NEW " + guid + "\n")
                 p = Post(index=0, body=" ", title="", guid=guid)
                 p.found = timezone.now()
-                changed = True
 
 
                 try:
@@ -533,44 +602,45 @@ def parse_feed_xml(source_feed, feed_content, output):
 
 
                 p.source = source_feed
-                p.save()
+                new_posts.append(p)
+
+            posts[guid] = p
     
             try:
                 p.title = e.title
-                p.save(update_fields=["title"])
             except Exception as ex:
                 output.write("Title error:" + str(ex))
                             
             try:
                 p.link = e.link
-                p.save(update_fields=["link"])
             except Exception as ex:
                 output.write("Link error:" + str(ex))
 
             try:
                 p.image_url = e.image.href
-                p.save(update_fields=["image_url"])
             except:
                 pass
 
-
-        
             try:
                 p.author = e.author
-                p.save(update_fields=["author"])
             except Exception as ex:
-                p.author = ""
+                pass
 
+            p.body = body
 
+        _save_posts(source_feed, new_posts, existing, ["title", "link", "image_url", "author", "body"])
+        posts.update(existing)
 
-            try:
-                p.body = body                          
-                p.save(update_fields=["body"])
-                # output.write(p.body)
-            except Exception as ex:
-                output.write(str(ex))
-                output.write(p.body)                
+        if any(p.guid not in existing for p in new_posts):
+            changed = True
 
+        new_enclosures = []
+        for guid, (e, body) in items.items():
+            p = posts[guid]
+            if p.id is None:
+                continue
+            
+            current = list(p.enclosures.all()) if guid in existing else []
             
             try:
                 seen_files = []
@@ -592,7 +662,7 @@ def parse_feed_xml(source_feed, feed_content, output):
                     post_files += non_dupes
                 
                 
-                for ee in list(p.enclosures.all()):
+                for ee in current:
                     # check existing enclosure is still there
                     found_enclosure = False
                     for pe in post_files:
@@ -668,13 +738,15 @@ def parse_feed_xml(source_feed, feed_content, output):
 
 
 
-                            ee.save()
+                            new_enclosures.append(ee)
                     except Exception as ex:
                         pass
             except Exception as ex:
                 if output:
                     output.write("No enclosures - " + str(ex))
 
+        Enclosure.objects.bulk_create(new_enclosures, batch_size=500)
+
 
     if is_first and source_feed.posts.all().count() > 0:
         # If this is the first time we have parsed this 
@@ -769,6 +841,8 @@ def parse_feed_json(source_feed, feed_content, output):
 
         #output.write(entries)
         entries.reverse() # Entries are typically in reverse chronological order - put them in right order
+
+        items = {}  # guid -> (entry, body), a guid repeated in the feed takes the last entry
         for e in entries:
             body = " "
             if "content_text" in e:
@@ -789,17 +863,27 @@ def parse_feed_json(source_feed, feed_content, output):
                     m = hashlib.md5()
                     m.update(body.encode("utf-8"))
                     guid = m.hexdigest()
-                    
-            try:
-                p  = Post.objects.filter(source=source_feed).filter(guid=guid)[0]
+
+            items[guid] = (e, body)
+
+        existing = _existing_posts(source_feed, items.keys())
+        posts = {}
+        new_posts = []
+
+        for guid, (e, body) in items.items():
+
+            if guid in existing:
+                p = existing[guid]
                 output.write("EXISTING " + guid + "\n")
 
-            except Exception as ex:
+            else:
                 output.write("NEW " + guid + "\n")
-                p = Post(index=0, body=' ')
+                p = Post(index=0, body=' ', guid=guid)
                 p.found = timezone.now()
-                changed = True
                 p.source = source_feed
+                new_posts.append(p)
+
+            posts[guid] = p
     
             try:
                 title = e["title"]
@@ -834,18 +918,30 @@ def parse_feed_json(source_feed, feed_content, output):
                 p.created  = timezone.now()
         
         
-            p.guid = guid
             try:
                 p.author = e["author"]
             except Exception as ex:
                 p.author = ""
-                
-            p.save()
-            
+
+            p.body = body
+
+        _save_posts(source_feed, new_posts, existing, ["title", "image_url", "link", "created", "author", "body"])
+        posts.update(existing)
+
+        if any(p.guid not in existing for p in new_posts):
+            changed = True
+
+        new_enclosures = []
+        for guid, (e, body) in items.items():
+            p = posts[guid]
+            if p.id is None:
+                continue
+
+            current = list(p.enclosures.all()) if guid in existing else []
 
             try:
                 seen_files = []
-                for ee in list(p.enclosures.all()):
+                for ee in current:
                     # check existing enclosure is still there
                     found_enclosure = False
                     if "attachments" in e:
@@ -887,21 +983,14 @@ def parse_feed_json(source_feed, feed_content, output):
                                 except:
                                     type = "audio/mpeg"
                     
-                                ee = Enclosure(post=p , href=pe["url"], length=length, type=type)
-                                ee.save()
+                                new_enclosures.append(Enclosure(post=p , href=pe["url"], length=length, type=type))
                         except Exception as ex:
                             pass
             except Exception as ex:
                 if output:
                     output.write("No enclosures - " + str(ex))
 
-            try:
-                p.body = body                       
-                p.save()
-                # output.write(p.body)
-            except Exception as ex:
-                output.write(str(ex))
-                output.write(p.body)
+        Enclosure.objects.bulk_create(new_enclosures, batch_size=500)
 
     return (ok,changed)
     
@@ -935,12 +1024,14 @@ def test_feed(source, cache=False, output=NullOutput()):
     
 def get_proxy(out=NullOutput()):
 
-    p = WebProxy.objects.first()
+    proxies = WebProxy.cached_proxies()
     
-    if p is None:
+    if not proxies:
         find_proxies(out)
-        p = WebProxy.objects.first()
+        proxies = WebProxy.cached_proxies()
     
+    p = proxies[0] if proxies else None
+
     out.write("Proxy: {}".format(str(p)))
     
     return p 
@@ -962,10 +1053,7 @@ def find_proxies(out=NullOutput()):
             # remove header
             list = list[4:]
             
-            for item in list:
-                if ":" in item:
-                    item = item.split(" ")[0]
-                    WebProxy(address=item).save()
+            WebProxy.objects.bulk_create([WebProxy(address=item.split(" ")[0]) for item in list if ":" in item])
 
 
                         
@@ -976,9 +1064,10 @@ def find_proxies(out=NullOutput()):
     if WebProxy.objects.count() == 0:
         # something went wrong.
         # to stop infinite loops we will insert duff proxys now
-        for i in range(20):
-            WebProxy(address="X").save()
+        WebProxy.objects.bulk_create([WebProxy(address="X") for i in range(20)])
         out.write("No proxies found.\n")
+
+    WebProxy.clear_cache()
     
 def import_opml(opml_data: str):
     try: